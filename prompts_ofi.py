@@ -1,132 +1,174 @@
+import atexit
+import threading
 import streamlit as st
 import snowflake.connector
+from snowflake.connector.errors import ProgrammingError
 account = st.secrets['account']
 warehouse = st.secrets['warehouse']
  
 #generate sql
 GEN_SQL = """
-You will be acting as an AI Snowflake SQL expert named OFI-ChatBot; except when you need to provide description about a brand.
-Your goal is to give correct, executable SQL queries to end-users, depending upon whether the logged-in user has role of "end_user", "enterprise_user".
- 
-You are given a database named "OFI_DB" & schema named "OFI_SCHEMA". The OFI_SCHEMA has the following:
- 
-{tables}
+You are OFI-ChatBot, a Snowflake SQL expert. Give correct, executable
+SQL for the logged-in user; brand summaries also get a short text.
+
+<schema>
+Database "OFI_DB", schema "OFI_SCHEMA". Tables: {tables}
 {context}
- 
-The logged in user has username= "{username}" which has a role= "{role}". If the username has role = "user", do not generate query if the information asked involves fetching information pertaining to other username/customer and display a message display a message saying: "Sorry, we don't have this information".
- 
-Here are 11 critical rules for the interaction you must abide:
+</schema>
+
+<user>
+username="{username}", role="{role}".
+{access}
+</user>
+
 <rules>
-3. When generating sql query, you MUST wrap each generated SQL query within ``` sql code markdown in this format:
+- Wrap each SQL query in its own ```sql code block, e.g.
 ```sql
 select 1;
 ```
-```sql
-select 2;
-```
-Do not generate any additional text after or before the '''sql code markdown.
-4. Do not add any information regarding what the query will do. Only generate the sql query and nothing else.
-6. If the where clause invloves matching a column with  Text/string type value, use ILIKE operator for matching.g ilike %keyword% .
-7. Make sure to generate a single Snowflake SQL code snippet, not multiple.
-8. DO NOT put numerical at the very front of SQL variable.
-9. ALWAYS include fully qualified table names in every SQL query. eg. "OFI_DB.OFI_SCHEMA.CONSUMERS"
-10. All results should be in ascending order based on first column.
-11. Make sure you follow the following format for the columns of type DATE : 'YYYY-MM-DD'.
-12. Macros is defined as the quantity of carbohydrates,proteins and fats per 100 g of the product.
-13. Do not use alias for SALE_DATE column in the table OFI_DB.OFI_SCHEMA.SALES.
-13. Do not use alias for QUANTITY column in the table OFI_DB.OFI_SCHEMA.SALES.
-14. Use ALIAS TOTAL_REVENUE for sum of revenue.
- 
-NOTE: To fetch REVENUE column data mentioned in point g above, join the PRODUCTS table with SALES table.
-NOTE: Do Not use any ALIAS for the REVENUE column
-14. Whenever the user query involves summary report for a brand,
-(1)Generate a brief description text(what it does? how long in the business?, etc) of the brand in not more than 100 words. End this description with a fictious line saying that the brand has been our esteemed client since <year>. Choose <year> randomly in the range between 2000 and 2020.
-(2)  Generate 2 sql queries as follows:
-(i) the 1st sql query should fetch the below information:
-a. Brand
-b. revenue generated quarter-wise and the year the quarter falls in  as QUARTER_YEAR column.
-c. Use QUARTER_YEAR ALIAS for the above point b. Use the follwing format for the values in QUARTER_YEAR: <year>-<quarter number> Example: 2020-Q1,2020-Q2,2020-Q3,2020-Q4,2021-Q1,etc,.. upto 2023-Q4. Remember that there are only 4 quarters in a year. Sort the result by last 4 characters in QUARTER_YEAR and first two characters in QUARTER_YEAR.
-d. Sort by QUARTER_YEAR.
-NOTE: Do Not use any ALIAS for the REVENUE column
-NOTE: The brand name mentioned in point a above should be fetched from the Brand column of PRODUCTS table.
-NOTE: To fetch revenue related data mentioned in point b above, join the PRODUCTS table with SALES table. Do Not join with the MARKETRENDS table.
-(ii) the 2nd sql query should group by each product of brand specified above and show the revenue for each product of the brand.
- 
- 
+- Output only the SQL blocks; never explain what the query does.
+- One SQL query per request, except for brand summaries.
+- Match text/string columns with ILIKE '%keyword%'.
+- Never start an identifier with a digit.
+- Always use fully qualified names, e.g. OFI_DB.OFI_SCHEMA.CONSUMERS.
+- Order results ascending by the first column.
+- Format DATE values as 'YYYY-MM-DD'.
+- Macros = carbohydrates, proteins and fats per 100 g of product.
+- No alias for SALES.SALE_DATE, SALES.QUANTITY or REVENUE.
+- Alias the sum of revenue as TOTAL_REVENUE.
+- Get REVENUE by joining PRODUCTS with SALES.
+</rules>
+
+<brand_summary>
+When the user asks for a summary report of a brand:
+1. Brand description, at most 100 words (what it does, years in
+   business). End with a fictitious line saying the brand has been
+   our esteemed client since <year>, a random year in 2000-2020.
+2. SQL 1: BRAND (from PRODUCTS.BRAND) and revenue per quarter as
+   QUARTER_YEAR, formatted '<year>-Q<n>' (2020-Q1 .. 2023-Q4),
+   sorted by year then quarter. Join PRODUCTS with SALES only,
+   never with MARKETRENDS.
+3. SQL 2: revenue per product of that brand.
+</brand_summary>
 """
  
  
 DATABASE = "OFI_DB"
 SCHEMA = "OFI_SCHEMA"
  
-# Get the table names from the database
-@st.cache_data(show_spinner=False)
-def get_table_names(DATABASE, SCHEMA):
-    #st.write(st.session_state.username,st.session_state.password, st.session_state.role)
-    conn = snowflake.connector.connect(
-    user=st.session_state.username,
-    password=st.session_state.password,
-     role = st.session_state.role,
+# Tables described in the prompt for each role in roles.csv; None (or an unlisted role) gets the whole schema
+ROLE_TABLES = {
+    "sales_role": ["CONSUMERS", "PRODUCTS", "SALES"],
+    "admin_role": None,
+    "ACCOUNTADMIN": None,
+}
+
+# Roles allowed to query other users'/customers' data; every other role gets RESTRICTED_ACCESS
+UNRESTRICTED_ROLES = {"sales_role", "admin_role", "ACCOUNTADMIN"}
+
+RESTRICTED_ACCESS = (
+    "Never query data of other users/customers;\n"
+    "reply only: \"Sorry, we don't have this information\"."
+)
+ 
+# Snowflake error raised when a session's authentication token has expired
+SESSION_EXPIRED = 390114
+
+# Connections most recently created by get_conn, closed once at interpreter exit
+_open_conns = {}
+_open_conns_lock = threading.Lock()
+
+
+@atexit.register
+def _close_conns():
+    with _open_conns_lock:
+        for conn in _open_conns.values():
+            conn.close()
+
+
+# Connect and disconnect straight away; used to verify credentials at login
+def check_credentials(user, password, role):
+    snowflake.connector.connect(
+    user=user,
+    password=password,
+    role=role,
     account=account,
-    warehouse= warehouse
-        )
-    conn = conn.cursor()
-    conn.execute(f"use role {st.session_state.role};")
-    tables_df = conn.execute(
-        f"""
-        SELECT DISTINCT TABLE_NAME
-        FROM {DATABASE}.INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA ='{SCHEMA}'
-        ORDER BY TABLE_NAME;
-        """
-    )
-    list = tables_df.fetchall()
-    tables_list = [x[0] for x in list]
-    return tables_list
- 
- 
-# Get the table context from the database--data type and column  names  
-@st.cache_data(show_spinner=False)
-def get_table_context(table):
+    warehouse=warehouse
+        ).close()
+
+
+# One Snowflake connection per (user, role), reused across reruns and queries
+@st.cache_resource(show_spinner=False, ttl=3600, max_entries=32, validate=lambda conn: not conn.is_closed())
+def get_conn(user, password, role):
     conn = snowflake.connector.connect(
-    user=st.session_state.username,
-    password=st.session_state.password,
-    role = st.session_state.role,
+    user=user,
+    password=password,
+    role=role,
     account=account,
     warehouse=warehouse
         )
-    conn = conn.cursor()
-    conn.execute(f"use role {st.session_state.role};")
-    conn.execute(
-        f"""
-        SELECT COLUMN_NAME, DATA_TYPE
+    with _open_conns_lock:
+        _open_conns[(user, password, role)] = conn
+    return conn
+
+
+# Run fn(conn) on the cached connection; reconnect once if the session has expired
+def with_conn(user, password, role, fn):
+    conn = get_conn(user, password, role)
+    try:
+        return fn(conn)
+    except ProgrammingError as e:
+        if e.errno != SESSION_EXPIRED:
+            raise
+        # Closing fails validation for this entry only, so get_conn reconnects just this user/role
+        conn.close()
+        return fn(get_conn(user, password, role))
+ 
+ 
+# Get the table names and their context from the database--data type and column names
+# (not cached itself; _assemble_prompt caches the result so the schema is at most an hour old)
+def get_schema_context(DATABASE, SCHEMA, role):
+    allowed = ROLE_TABLES.get(role)
+    table_filter = ""
+    if allowed is not None:
+        table_filter = "AND TABLE_NAME IN (" + ", ".join(f"'{t}'" for t in allowed) + ")"
+
+    query = f"""
+        SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE
         FROM {DATABASE}.INFORMATION_SCHEMA.COLUMNS
         WHERE TABLE_SCHEMA = '{SCHEMA}'
-        AND TABLE_NAME = '{table}';
-        """,
+        {table_filter}
+        ORDER BY TABLE_NAME, ORDINAL_POSITION;
+        """
+    columns_df = with_conn(
+        st.session_state.username, st.session_state.password, role,
+        lambda conn: conn.cursor().execute(query).fetch_pandas_all(),
     )
-    columns = conn.fetch_pandas_all()
-    columns = "\n".join(
-        [
-            f"- **{columns['COLUMN_NAME'][i]}**: {columns['DATA_TYPE'][i]}"
-            for i in range(len(columns["COLUMN_NAME"]))
-        ],
+
+    lines = (
+        "- **" + columns_df["COLUMN_NAME"].astype(str) + "**: " + columns_df["DATA_TYPE"].astype(str)
     )
-    context = f"""
-        The table name {table} has the following columns with their data types:
-        \n{columns}\n
-        """
-    return context
+    columns = lines.groupby(columns_df["TABLE_NAME"], sort=True).agg("\n".join)
+    tables_list = columns.index.tolist()
+    all_tables_context = "".join(
+        f"\nTable {table} (column: data type):\n{cols}\n" for table, cols in columns.items()
+    )
+    return tables_list, all_tables_context
  
  
+# Assemble the system prompt once per role; "{username}" is left unfilled
+@st.cache_resource(show_spinner=False, ttl=3600)
+def _assemble_prompt(role):
+    tables, all_tables_context = get_schema_context(DATABASE, SCHEMA, role)
+    access = "" if role in UNRESTRICTED_ROLES else RESTRICTED_ACCESS
+    return GEN_SQL.format(
+        tables=", ".join(tables), context=all_tables_context, username="{username}", role=role, access=access
+    )
+
+
 # Get the system prompt--inputs
 def get_system_prompt(username,role):
-    tables = get_table_names(DATABASE, SCHEMA)
-    all_tables_context = ""
-    for table in tables:
-        table_context = get_table_context(table)
-        all_tables_context += table_context
-    return GEN_SQL.format(tables=tables, context=all_tables_context, username=username,role=role)
+    return _assemble_prompt(role).replace("{username}", username)
  
  
 if __name__ == "__main__":
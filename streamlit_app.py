@@ -20,13 +20,12 @@ warehouse      = "COMPUTE_WH"
 #####################
 # Imports & config  #
 #####################
-import os, re, csv
+import os, re, csv, hashlib, threading
+from collections import OrderedDict
 import streamlit as st
-import plotly.express as px
-import google.generativeai as genai
-import snowflake.connector
+import streamlit.components.v1 as components
 from snowflake.connector.errors import DatabaseError, ProgrammingError
-from prompts_ofi import get_system_prompt
+from prompts_ofi import check_credentials, get_system_prompt, with_conn
 
 #####################
 # Gemini API config #
@@ -35,7 +34,19 @@ GEMINI_KEY = st.secrets.get("GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY")
 if not GEMINI_KEY:
     st.stop()
 
-genai.configure(api_key=GEMINI_KEY)
+
+# Gemini SDK and Plotly are imported on first use, so the login page never loads them
+@st.cache_resource(show_spinner=False)
+def _genai():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_KEY)
+    return genai
+
+
+@st.cache_resource(show_spinner=False)
+def _px():
+    import plotly.express as px
+    return px
 
 #####################
 # Constants         #
@@ -44,6 +55,15 @@ DATABASE  = "OFI_DB"
 SCHEMA    = "OFI_SCHEMA"
 account   = st.secrets["account"]
 warehouse = st.secrets["warehouse"]
+_SQL_RE   = re.compile(r"```sql\s+(.*?)\s+```", re.DOTALL)
+# SQL blocks in a reply, including an unterminated one
+_SQL_PARTIAL_RE = re.compile(r"```sql.*?(```|$)", re.DOTALL)
+SMALL_TALK = {
+    "hi": "Hello {username}! What would you like to know?",
+    "hello": "Hello {username}! What would you like to know?",
+    "thanks": "You're welcome! Anything else I can help with?",
+}
+REPLY_CACHE_SIZE = 256
 
 #####################
 # Page setup        #
@@ -64,10 +84,7 @@ with col3:
 
 def isAuthenticated(database: str, schema: str, username: str, role: str, password: str) -> bool:
     try:
-        conn = snowflake.connector.connect(
-            user=username, password=password, role=role, account=account, warehouse="COMPUTE_WH"
-        )
-        conn.close()
+        check_credentials(username, password, role)
         st.success("Connection to Snowflake established successfully.")
         return True
     except (ProgrammingError, DatabaseError) as e:
@@ -77,14 +94,19 @@ def isAuthenticated(database: str, schema: str, username: str, role: str, passwo
     return False
 
 
+@st.cache_data(show_spinner=False, ttl=None)
+def _load_roles():
+    with open("roles.csv", newline="") as f:
+        return [row["role"] for row in csv.DictReader(f)]
+
+
 def display_login_form():
     username = st.sidebar.text_input("Username")
     password = st.sidebar.text_input("Password", type="password")
 
     roles = []
     try:
-        with open("roles.csv", newline="") as f:
-            roles = [row["role"] for row in csv.DictReader(f)]
+        roles = _load_roles()
     except Exception as e:
         st.sidebar.error(f"Error loading roles.csv: {e}")
 
@@ -101,12 +123,121 @@ def display_login_form():
 
 
 def plot_graph(results, message):
-    if not results.empty and {"year", "revenue"}.issubset(results.columns):
-        fig = px.bar(results, x="year", y="revenue", title="Revenue by Year")
+    if results.num_rows and {"year", "revenue"}.issubset(results.column_names):
+        # Only the plotted columns are converted to pandas
+        fig = _px().bar(results.select(["year", "revenue"]).to_pandas(), x="year", y="revenue", title="Revenue by Year")
         st.plotly_chart(fig, use_container_width=True)
-        message["fig"] = fig
+        # Serialise once; history re-renders reuse the HTML instead of the figure
+        message["fig_html"] = fig.to_html(include_plotlyjs="cdn", full_html=False)
     return message
 
+
+@st.cache_resource(show_spinner=False)
+def _get_model():
+    return _genai().GenerativeModel("gemini-1.5-flash")
+
+
+# Gemini replies shared across sessions with the lock guarding them; least recently used evicted first
+@st.cache_resource(show_spinner=False)
+def _reply_cache():
+    return OrderedDict(), threading.Lock()
+
+
+def _normalize_prompt(prompt):
+    return prompt.lower().strip().strip("!.?").strip()
+
+
+# Keyed on the whole conversation so far, so follow-ups only match the same context
+def _reply_key(prompt):
+    digest = hashlib.blake2b()
+    for msg in st.session_state.messages[1:-1]:
+        digest.update(msg["content"].encode() + b"\0")
+    digest.update(_normalize_prompt(prompt).encode())
+    return (st.session_state.role, st.session_state.username, digest.hexdigest())
+
+
+def _get_cached_reply(key):
+    cache, lock = _reply_cache()
+    with lock:
+        reply = cache.get(key)
+        if reply is not None:
+            cache.move_to_end(key)
+        return reply
+
+
+def _cache_reply(key, reply):
+    cache, lock = _reply_cache()
+    with lock:
+        cache[key] = reply
+        if len(cache) > REPLY_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+# Render one stored chat turn; charts use the HTML serialised when they were first drawn
+def render_message(msg):
+    with st.chat_message("assistant" if msg["role"] == "assistant" else "user"):
+        if msg.get("sql"):
+            if text := visible_text(msg["content"]):
+                st.write(text)
+            with st.expander("Show SQL Query"):
+                for sql in _SQL_RE.findall(msg["content"]):
+                    st.code(sql.strip(), language="sql")
+            if msg.get("results") is not None and msg["results"].num_rows:
+                st.dataframe(msg["results"])
+            if fig_html := msg.get("fig_html"):
+                components.html(fig_html, height=470)
+        else:
+            st.write(msg["content"])
+
+
+# Yield streamed text with ```sql blocks left out; the raw chunks are collected in parts
+def _without_sql(stream, parts):
+    pending, in_sql = "", False
+    for part in stream:
+        parts.append(part.text)
+        pending += part.text
+        while True:
+            if in_sql:
+                end = pending.find("```")
+                if end < 0:
+                    pending = pending[-2:]  # may hold the start of the closing fence
+                    break
+                pending, in_sql = pending[end + 3:], False
+            else:
+                start = pending.find("```sql")
+                if start < 0:
+                    text, pending = pending[:-5], pending[-5:]  # may hold the start of a fence
+                    if text:
+                        yield text
+                    break
+                if start:
+                    yield pending[:start]
+                pending, in_sql = pending[start + 6:], True
+    if pending and not in_sql:
+        yield pending
+
+
+# Stream the reply as it arrives; SQL blocks are hidden since they are shown under Insights
+def stream_reply(stream):
+    parts = []
+    st.write_stream(_without_sql(stream, parts))
+    return "".join(parts)
+
+
+def visible_text(reply):
+    return _SQL_PARTIAL_RE.sub("", reply).strip()
+
+
+# Send every generated SQL block in one multi-statement round trip; one Arrow table per block.
+# The separator sits on its own line so a trailing "-- comment" cannot swallow it.
+def run_sql_batch(conn, sql_blocks):
+    cur = conn.cursor()
+    cur.execute("\n;\n".join(q.rstrip(";") for q in sql_blocks), num_statements=len(sql_blocks))
+    tables = [cur.fetch_arrow_all(force_return_table=True)]
+    while cur.nextset():
+        tables.append(cur.fetch_arrow_all(force_return_table=True))
+    return tables
+
 #####################
 # Chat logic        #
 #####################
@@ -117,10 +248,12 @@ def chatbot():
     # Initialise conversation state without system role
     if "messages" not in st.session_state:
         if {"username", "role"}.issubset(st.session_state):
-            st.session_state.messages = [{
-                "role": "user",
-                "content": get_system_prompt(st.session_state.username, st.session_state.role),
-            }]
+            system_prompt = get_system_prompt(st.session_state.username, st.session_state.role)
+            st.session_state.messages = [{"role": "user", "content": system_prompt}]
+            # One Gemini chat per session; it keeps the system prompt and past turns itself
+            st.session_state.chat_session = _get_model().start_chat(
+                history=[{"role": "user", "parts": [system_prompt]}]
+            )
         else:
             st.error("You must log in first.")
             return
@@ -136,17 +269,7 @@ def chatbot():
 
     # Render history
     for msg in st.session_state.messages:
-        with st.chat_message("assistant" if msg["role"] == "assistant" else "user"):
-            if msg.get("sql"):
-                if msg["content"]:
-                    with st.expander("Show SQL Query"):
-                        st.markdown(msg["content"])
-                if msg.get("results") is not None and not msg["results"].empty:
-                    st.dataframe(msg["results"])
-                if fig := msg.get("fig"):
-                    st.write(fig)
-            else:
-                st.write(msg["content"])
+        render_message(msg)
 
     #########################
     # User prompt & Gemini  #
@@ -157,54 +280,78 @@ def chatbot():
 
     st.session_state.messages.append({"role": "user", "content": prompt})
 
-    with st.spinner("Thinking..."):
-        history_for_gemini = [
-            {"role": ("model" if m["role"] == "assistant" else "user"), "parts": [m["content"]]}
-            for m in st.session_state.messages[:-1]
-        ]
+    chat_session = st.session_state.chat_session
 
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        chat_session = model.start_chat(history=history_for_gemini)
+    key = _reply_key(prompt)
+    canned = SMALL_TALK.get(_normalize_prompt(prompt))
+    cached = _get_cached_reply(key)
 
+    # Render the reply as it streams in; small talk and repeated prompts skip Gemini
+    with st.chat_message("assistant"):
         try:
-            stream = chat_session.send_message(prompt, stream=True)
-            reply = "".join(part.text for part in stream)
+            if canned or cached:
+                reply = canned.format(username=st.session_state.username) if canned else cached
+                if text := visible_text(reply):
+                    st.write(text)
+                # Record the turn so later Gemini calls still see it
+                chat_session.history = chat_session.history + [
+                    {"role": "user", "parts": [prompt]},
+                    {"role": "model", "parts": [reply]},
+                ]
+            else:
+                stream = chat_session.send_message(prompt, stream=True)
+                completed = False
+                try:
+                    reply = stream_reply(stream)
+                    completed = True
+                finally:
+                    # A broken, blocked or rerun-interrupted stream would poison every later turn
+                    if not completed:
+                        chat_session.rewind()
+                _cache_reply(key, reply)
         except AttributeError:
             reply = chat_session.send_message(prompt).text
+            if text := visible_text(reply):
+                st.write(text)
         except Exception as e:
             st.error(f"Gemini API error: {e}")
             reply = "Sorry, I hit an error processing your request."
+            st.write(reply)
 
     assistant_msg = {"role": "assistant", "content": reply}
 
     ################################################
     # SQL detection & execution                    #
     ################################################
-    sql_blocks = re.findall(r"```sql\s+(.*?)\s+```", reply, flags=re.DOTALL)
+    sql_blocks = _SQL_RE.findall(reply)
     sql_blocks = [q.strip() for q in sql_blocks]
 
     if sql_blocks:
         assistant_msg["sql"] = sql_blocks[0]
-        summary_model = genai.GenerativeModel("gemini-1.5-flash")
+        summary_model = _get_model()
 
-        for idx, sql in enumerate(sql_blocks, 1):
+        try:
+            results = with_conn(
+                st.session_state.username, st.session_state.password, st.session_state.role,
+                lambda conn: run_sql_batch(conn, sql_blocks),
+            )
+        except (DatabaseError, ProgrammingError) as sn_ex:
+            st.error(f"Snowflake error: {sn_ex.msg}")
+            results = []
+        except Exception as e:
+            st.error(f"Unexpected error: {e}")
+            results = []
+
+        for idx, (sql, table) in enumerate(zip(sql_blocks, results), 1):
             try:
-                with snowflake.connector.connect(
-                    user=st.session_state.username,
-                    password=st.session_state.password,
-                    role=st.session_state.role,
-                    account=account,
-                    warehouse=warehouse,
-                ) as conn:
-                    df = conn.cursor().execute(sql).fetch_pandas_all()
-
-                if df.empty:
+                if not table.num_rows:
                     st.warning("The requested data is not available in the database.")
                     continue
 
+                preview = table.slice(0, 20).to_pandas().astype(str).apply(lambda col: col.str.slice(0, 40))
                 prompt_desc = (
-                    "Provide a concise, reader‑friendly description of the following table. "
-                    "For revenue figures, express the unit as 'million dollars'.\n\n" + df.head(20).to_markdown()
+                    "Provide a concise, reader‑friendly description of the following CSV table. "
+                    "For revenue figures, express the unit as 'million dollars'.\n\n" + preview.to_csv(index=False)
                 )
                 description = summary_model.generate_content(prompt_desc).text.strip()
 
@@ -213,15 +360,11 @@ def chatbot():
                     st.code(sql, language="sql")
                 st.markdown(f"<div class='big-font'>{description}</div>", unsafe_allow_html=True)
 
-                assistant_msg["results"] = df
-                assistant_msg = plot_graph(df, assistant_msg)
+                assistant_msg["results"] = table
+                assistant_msg = plot_graph(table, assistant_msg)
 
-            except (DatabaseError, ProgrammingError) as sn_ex:
-                st.error(f"Snowflake error: {sn_ex.msg}")
             except Exception as e:
                 st.error(f"Unexpected error: {e}")
-    else:
-        st.write(reply)
 
     st.session_state.messages.append(assistant_msg)
 